@@ -1,19 +1,31 @@
 import hashlib
 import logging
+import random
+import time
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
-from typing import Any, Optional, TypedDict
+from typing import Any, Callable, Iterator, Mapping, Optional, Sequence, TypedDict
+from urllib.parse import unquote
 
 import boto3
+import pulumi_aws
+import yaml
+from botocore.config import Config
+from botocore.exceptions import ClientError
 from pulumi import Input, Output, ResourceOptions
 from pulumi_aws import s3 as pulumi_s3
 from serde import serde, to_dict
-from serde.yaml import from_yaml, to_yaml
+from serde.yaml import YamlSerializer, from_yaml
 
 from shopkeeper.base_market import (
     Market,
     MarketClient,
     MarketMetadataV1,
+    ResourceMetadata,
+    ResourceMetadataVersion,
 )
+from shopkeeper.profiling import profiled
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -27,6 +39,11 @@ class AwsMarketV1Args(TypedDict):
 
     metadata: MarketMetadataV1
     bucket_prefix: Input[str]
+    # an S3-compatible endpoint (e.g. moto server or MinIO) to use instead of AWS.
+    # Plain, so that the provider of the bucket is known when it is declared.
+    endpoint_url: Optional[str]
+    # metadata fields to maintain secondary indexes for, e.g. ["environment"]
+    indexed_fields: Optional[list[str]]
 
 
 class AwsMarketV1Config(TypedDict):
@@ -38,6 +55,8 @@ class AwsMarketV1Config(TypedDict):
     bucket: Input[str]
     region: Input[str]
     market_metadata_key: Input[str]
+    endpoint_url: Optional[Input[str]]
+    indexed_fields: Optional[list[str]]
 
 
 @serde
@@ -57,6 +76,17 @@ class AwsMarketV1Data:
     bucket_arn: str
 
 
+@dataclass
+class _SerializedMetadata:
+    """
+    Metadata serialized once, for both storage and outputs
+    """
+
+    content: str  # yaml
+    etag: str  # md5 of content
+    data: dict[str, Any]
+
+
 class AwsMarketV1(Market):
     """
     A Market implemented on AWS, using standard file-based metadata storage
@@ -71,8 +101,21 @@ class AwsMarketV1(Market):
     def __init__(self, name, args: AwsMarketV1Args, opts):
         super().__init__(name, args, opts)
 
+        typ = self.__class__.__name__
         filename = Market.get_market_metadata_key(name=name)
         bucket_prefix = args.get("bucket_prefix", None)
+        endpoint_url = args.get("endpoint_url", None)
+        indexed_fields = args.get("indexed_fields", None)
+
+        # point the aws provider at a local endpoint, if one is configured
+        bucket_opts = None
+        if endpoint_url is not None:
+            provider = _endpoint_provider(
+                f"{name}-provider",
+                endpoint_url=endpoint_url,
+                opts=ResourceOptions(parent=self),
+            )
+            bucket_opts = ResourceOptions(provider=provider)
 
         # create bucket and set permissions
         bucket = pulumi_s3.BucketV2(
@@ -80,6 +123,7 @@ class AwsMarketV1(Market):
             bucket_prefix=bucket_prefix,
             force_destroy=True,
             tags=None,
+            opts=bucket_opts,
         )
         pulumi_s3.BucketOwnershipControls(
             f"{name}-bucket-writer-owns",
@@ -93,13 +137,15 @@ class AwsMarketV1(Market):
         # Market data
         def prepare_market_data(d) -> AwsMarketV1Data:
             market_data = AwsMarketV1Data(
-                market_type=self.__class__.__name__,
+                market_type=typ,
                 name=name,
                 metadata=d["metadata"],
                 configuration=AwsMarketV1Config(
                     bucket=d["bucket"],
                     region=d["region"],
                     market_metadata_key=filename,
+                    endpoint_url=d["endpoint_url"],
+                    indexed_fields=indexed_fields,
                 ),  # type: ignore
                 region=d["region"],
                 bucket=d["bucket"],
@@ -112,25 +158,27 @@ class AwsMarketV1(Market):
             region=bucket.region,
             bucket_arn=bucket.arn,
             metadata=args["metadata"],
-        ).apply(prepare_market_data)
+            endpoint_url=endpoint_url,
+        ).apply(profiled(prepare_market_data, typ, name, "prepare_market_data"))
 
-        market_data_serialized = market_data.apply(to_yaml)
-        etag = market_data_serialized.apply(
-            lambda s: hashlib.md5(s.encode()).hexdigest()
+        # serialize to yaml, calculate Etag and convert to dict in one go
+        serialized = market_data.apply(
+            profiled(_serialize_metadata, typ, name, "serialize_metadata")
         )
 
         # declare the metadata file on object storage as a json file
-        pulumi_s3.BucketObjectv2(
+        metadata_object = pulumi_s3.BucketObjectv2(
             f"{name}-metadata-yaml",
             bucket=bucket.bucket,
             key=filename,
-            content=market_data_serialized,
+            content=serialized.content,
             content_type="text/yaml",
             opts=ResourceOptions(parent=bucket),
-            etag=etag,
+            etag=serialized.etag,
         )
+        _drop_outputs_when_registered(metadata_object)
 
-        market_data_as_dict = market_data.apply(to_dict)
+        market_data_as_dict = serialized.data
         self.market_data = market_data_as_dict
         self.market_configuration = market_data_as_dict.apply(
             lambda x: x["configuration"]
@@ -147,25 +195,46 @@ class AwsMarketV1(Market):
 class AwsMarketV1Client(MarketClient):
     """
     A client to connect to and interact with an AwsMarketV1 Market
+
+    name and opts.parent identify the component that owns the client (e.g. a
+    producer), and are used for the resources that the client declares on its own,
+    such as the aws provider of a market on an S3-compatible endpoint.
     """
 
     market_configuration: Output[AwsMarketV1Config]
     market_data: Output[AwsMarketV1Data]
+    endpoint_url: Output[Optional[str]]
 
-    def __init__(self, market_configuration: AwsMarketV1Config):
+    def __init__(
+        self,
+        market_configuration: AwsMarketV1Config,
+        name: Optional[str] = None,
+        opts: Optional[ResourceOptions] = None,
+    ):
         super().__init__()
         self.market_configuration = Output.from_input(market_configuration)
-
-        def _load_market(d: dict[str, str]) -> AwsMarketV1Data:
-            data = _read_s3_file(**d)
-            market_data = from_yaml(AwsMarketV1Data, data)
-            return market_data
-
-        self.market_data = Output.all(
-            region=market_configuration["region"],
-            bucket=market_configuration["bucket"],
-            key=market_configuration["market_metadata_key"],
-        ).apply(_load_market)
+        # the configuration is an Output when it comes from another stack, so the
+        # endpoint is always resolved from it rather than read from the dict
+        self.endpoint_url = self.market_configuration.apply(
+            lambda c: c.get("endpoint_url", None)
+        )
+        self._configuration = market_configuration
+        self._settings = _plain_settings(market_configuration)
+        if self._settings is not None:
+            self.indexed_fields = self._settings[1]
+        self._name = name
+        self._parent = None if opts is None else opts.parent
+        self._provider: Optional[pulumi_aws.Provider] = None
+        self._bucket_client: Optional[tuple[Any, str]] = None
+
+        self.market_data = self.market_configuration.apply(
+            lambda c: _load_market_data(
+                region=c["region"],
+                bucket=c["bucket"],
+                key=c["market_metadata_key"],
+                endpoint_url=c.get("endpoint_url", None),
+            )
+        )
 
     def declare_resource_metadata(
         self,
@@ -173,36 +242,500 @@ class AwsMarketV1Client(MarketClient):
         key: str,
         name: str,
         opts: Optional[ResourceOptions] = None,
+        indexed_fields: Optional[Sequence[str]] = None,
     ) -> Output[dict[str, Any]]:
         """
         Creates a bucket object called name with data and an etag at key.
         data must be a dataclass that is serializable with pyserde.
+
+        For each of indexed_fields (default: the market's indexed fields), an index
+        entry pointing at key is declared under the value of data.metadata[field].
+        Resources without the field are indexed under an empty value.
+
+        The endpoint_url and indexed_fields of the market configuration must be plain
+        values, as they decide which resources are declared. Other values, such as the
+        bucket from a stack reference, may be Outputs.
         """
-        # serialize to yaml and calculate Etag
-        data_serialized: Output[str] = data.apply(to_yaml)
-        etag: Output[str] = data_serialized.apply(
-            lambda s: hashlib.md5(s.encode()).hexdigest()
+        if self._settings is None:
+            raise ValueError(
+                "Declaring resource metadata requires a market configuration with "
+                "plain endpoint_url and indexed_fields, not Outputs"
+            )
+        endpoint_url, market_indexed_fields = self._settings
+
+        # serialize to yaml, calculate Etag and convert to dict in one go
+        serialized: Output[_SerializedMetadata] = data.apply(
+            profiled(
+                _serialize_metadata, self.__class__.__name__, name, "serialize_metadata"
+            )
         )
 
-        pulumi_s3.BucketObjectv2(
+        resource_opts = self._resource_options(opts, endpoint_url)
+        metadata_object = pulumi_s3.BucketObjectv2(
             f"{name}-metadata",
-            bucket=self.market_configuration.bucket,
+            bucket=self.market_configuration["bucket"],
             key=key,
-            content=data_serialized,
+            content=serialized.content,
             content_type="text/yaml",
-            opts=opts,
-            etag=etag,
+            opts=resource_opts,
+            etag=serialized.etag,
         )
+        _drop_outputs_when_registered(metadata_object)
+
+        if indexed_fields is None:
+            indexed_fields = market_indexed_fields
+        for field in indexed_fields:
+            index_key = serialized.apply(
+                lambda s, field=field: self.get_index_key(
+                    field, _metadata_value(s.data, field), key
+                )
+            )
+            pulumi_s3.BucketObjectv2(
+                f"{name}-index-{field}",
+                bucket=self.market_configuration["bucket"],
+                key=index_key,
+                content=key,
+                content_type="text/plain",
+                opts=resource_opts,
+            )
 
-        output_data = data.apply(to_dict)
+        output_data = serialized.data
         return output_data
 
+    def query_metadata_keys(self, field: str, value: str) -> list[str]:
+        """
+        Returns the keys of all resource metadata where metadata[field] == value.
+        Reads the index with a single list request per 1000 matches, regardless of
+        the size of the market. Only fields in indexed_fields are indexed.
+        """
+        s3, bucket = self._s3()
+        prefix = self.get_index_prefix(field, value).lstrip("/")
+        keys = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get("Contents", []):
+                keys.append(self.get_key_from_index_key(obj["Key"]))
+        return keys
+
+    def iter_resource_metadata(
+        self, batch_size: int = 1000, max_workers: int = 16
+    ) -> Iterator[ResourceMetadata]:
+        """
+        Yields the metadata of all producers and datasets in the market. Objects are
+        listed batch_size at a time, and each batch is fetched on a thread pool.
+        Objects deleted between listing and fetching are skipped.
+        """
+        s3, bucket = self._s3()
+        prefix = self.get_resource_metadata_prefix().lstrip("/")
+
+        def _get(key: str) -> Optional[dict[str, Any]]:
+            data, _ = _get_s3_object(s3, bucket, key)
+            return data
+
+        paginator = s3.get_paginator("list_objects_v2")
+        pages = paginator.paginate(
+            Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": batch_size}
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            for page in pages:
+                objects = [
+                    (obj, parsed)
+                    for obj in page.get("Contents", [])
+                    if (parsed := self.parse_resource_metadata_key(obj["Key"]))
+                ]
+                contents = pool.map(_get, [obj["Key"] for obj, _ in objects])
+                for (obj, (producer, dataset)), data in zip(objects, contents):
+                    if data is None:
+                        continue
+                    yield ResourceMetadata(
+                        key=obj["Key"],
+                        producer=producer,
+                        dataset=dataset,
+                        etag=obj["ETag"].strip('"'),
+                        last_modified=obj["LastModified"],
+                        data=data,
+                    )
+
+    def head_resource_metadata(
+        self, keys: Sequence[str], max_workers: int = 32
+    ) -> dict[str, Optional[ResourceMetadataVersion]]:
+        """
+        Returns the current version of each key (None if it doesn't exist), with HEAD
+        requests on a thread pool
+        """
+        s3, bucket = self._s3()
+
+        def _head(key: str) -> Optional[ResourceMetadataVersion]:
+            try:
+                response = s3.head_object(Bucket=bucket, Key=key.lstrip("/"))
+            except ClientError as e:
+                if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+                    return None
+                raise
+            return ResourceMetadataVersion(
+                etag=response["ETag"].strip('"'),
+                last_modified=response["LastModified"],
+            )
+
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            return dict(zip(keys, pool.map(_head, keys)))
+
+    def put_resource_status(
+        self, key: str, data: Any, if_match: Optional[str] = None
+    ) -> str:
+        """
+        Writes the status of a producer or dataset directly to the market, outside of
+        Pulumi, and returns its new etag. key must be a status key (see
+        get_dataset_status_key), as Pulumi would revert direct writes to the metadata
+        it declares. The write only succeeds if the current object has etag if_match,
+        or if no object exists when if_match is None. Otherwise a ClientError with code
+        PreconditionFailed (or ConditionalRequestConflict) is raised.
+
+        The index entries of the status are reconciled with its content afterwards.
+        """
+        if not self.is_status_key(key):
+            raise ValueError(
+                f"{key} is not a status key, only status is written outside of Pulumi"
+            )
+        s3, bucket = self._s3()
+        serialized = _serialize_metadata(data)
+        if if_match is None:
+            condition = {"IfNoneMatch": "*"}
+        else:
+            condition = {"IfMatch": f'"{if_match}"'}
+        response = s3.put_object(
+            Bucket=bucket,
+            Key=key.lstrip("/"),
+            Body=serialized.content.encode(),
+            ContentType="text/yaml",
+            **condition,
+        )
+        if self.indexed_fields:
+            self._reconcile_index_entries(key)
+        return response["ETag"].strip('"')
+
+    def update_resource_status(
+        self,
+        key: str,
+        update: Callable[[Optional[dict[str, Any]]], Any],
+        max_attempts: int = 5,
+    ) -> str:
+        """
+        Applies update to the current status at key (None if there is none) and
+        writes the result with put_resource_status. On a conflicting concurrent
+        write, the status is read again and update retried, up to max_attempts
+        times. Returns the new etag.
+        """
+        s3, bucket = self._s3()
+        attempt = 1
+        while True:
+            current, etag = _get_s3_object(s3, bucket, key)
+            data = update(current)
+            try:
+                new_etag = self.put_resource_status(key, data, if_match=etag)
+            except ClientError as e:
+                code = e.response["Error"]["Code"]
+                if code not in _CONFLICT_CODES or attempt >= max_attempts:
+                    raise
+                logger.info(f"conflict writing {key} ({code}), retrying")
+                time.sleep(random.uniform(0, 0.05 * 2**attempt))
+                attempt += 1
+                continue
+            return new_etag
+
+    def update_resource_status_batch(
+        self,
+        updates: Mapping[str, Callable[[Optional[dict[str, Any]]], Any]],
+        max_workers: int = 16,
+        max_attempts: int = 5,
+    ) -> dict[str, str]:
+        """
+        Applies update_resource_status to many keys concurrently, and returns the new
+        etag of each key
+        """
+        self._s3()  # create the boto3 client once, before sharing it across threads
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            futures = {
+                key: pool.submit(self.update_resource_status, key, update, max_attempts)
+                for key, update in updates.items()
+            }
+            return {key: future.result() for key, future in futures.items()}
+
+    def _reconcile_index_entries(self, key: str, max_attempts: int = 5) -> None:
+        """
+        Makes the index entries of the status at key match its current content. The
+        entry for the current value of each indexed field is written, and the entries
+        of key under all other values are deleted. This repeats until the status is
+        unchanged by concurrent writers, so entries from a stale read are cleaned up,
+        up to max_attempts times.
+
+        Only entries pointing at key are touched, never the entries that Pulumi
+        declares for the metadata next to it.
+        """
+        s3, bucket = self._s3()
+        for _ in range(max_attempts):
+            data, etag = _get_s3_object(s3, bucket, key)
+            for field in self.indexed_fields:
+                value = None if data is None else _metadata_value(data, field)
+                if value is not None:
+                    index_key = self.get_index_key(field, value, key)
+                    s3.put_object(
+                        Bucket=bucket, Key=index_key.lstrip("/"), Body=key.encode()
+                    )
+                stale = [
+                    {"Key": self.get_index_key(field, v, key).lstrip("/")}
+                    for v in self._index_values(field)
+                    if v != value
+                ]
+                for i in range(0, len(stale), 1000):
+                    s3.delete_objects(
+                        Bucket=bucket,
+                        Delete={"Objects": stale[i : i + 1000], "Quiet": True},
+                    )
+            version = self.head_resource_metadata([key], max_workers=1)[key]
+            if (None if version is None else version.etag) == etag:
+                return
+        # every writer reconciles after its own write, so the last one fixes this up
+        logger.warning(
+            f"index entries of {key} still changing after {max_attempts} attempts, "
+            "leaving them to the next writer"
+        )
+
+    def _index_values(self, field: str) -> list[str]:
+        """
+        Returns all values that field is indexed under, with one list request per
+        1000 values
+        """
+        s3, bucket = self._s3()
+        prefix = self.get_index_field_prefix(field).lstrip("/")
+        values = []
+        paginator = s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix, Delimiter="/"):
+            for common_prefix in page.get("CommonPrefixes", []):
+                values.append(unquote(common_prefix["Prefix"][len(prefix) : -1]))
+        return values
+
+    def _s3(self):
+        """
+        Returns a boto3 client and bucket name for reading the market directly,
+        outside of a Pulumi program. Requires a market configuration of plain values.
+        """
+        if self._bucket_client is not None:
+            return self._bucket_client
+        c = self._configuration
+        if not isinstance(c, dict) or any(
+            isinstance(c.get(k), Output) for k in ("bucket", "region", "endpoint_url")
+        ):
+            raise ValueError(
+                "Direct access to the market requires a market configuration of "
+                "plain values, not Outputs"
+            )
+        s3 = _s3_client(region=c["region"], endpoint_url=c.get("endpoint_url", None))
+        self._bucket_client = (s3, c["bucket"])
+        return self._bucket_client
+
+    def _resource_options(
+        self, opts: Optional[ResourceOptions], endpoint_url: Optional[str]
+    ) -> Optional[ResourceOptions]:
+        """
+        Merges an aws provider for the market's endpoint into opts, when the market
+        is served from an S3-compatible endpoint rather than AWS.
+
+        The provider is a child of the component that owns the client, and named
+        after it. Clients without an owner share one provider per endpoint.
+        """
+        if endpoint_url is None:
+            return opts
+        region = self.market_configuration["region"]
+        if self._provider is None and self._name is None:
+            self._provider = _shared_endpoint_provider(endpoint_url, region=region)
+        elif self._provider is None:
+            self._provider = _endpoint_provider(
+                f"{self._name}-market-provider",
+                endpoint_url=endpoint_url,
+                region=region,
+                opts=ResourceOptions(parent=self._parent),
+            )
+        return ResourceOptions.merge(opts, ResourceOptions(provider=self._provider))
+
+
+def _endpoint_provider(
+    name: str,
+    endpoint_url: Input[str],
+    region: Optional[Input[str]] = None,
+    opts: Optional[ResourceOptions] = None,
+) -> pulumi_aws.Provider:
+    """
+    An aws provider that talks to an S3-compatible endpoint (moto server, MinIO, ...).
+    Credentials are still read from the environment, but are not validated.
+    """
+    return pulumi_aws.Provider(
+        name,
+        opts=opts,
+        region=region,
+        endpoints=[pulumi_aws.ProviderEndpointArgs(s3=endpoint_url, sts=endpoint_url)],
+        s3_use_path_style=True,
+        skip_credentials_validation=True,
+        skip_metadata_api_check=True,
+        skip_region_validation=True,
+        skip_requesting_account_id=True,
+    )
+
+
+# providers of clients without an owning component, by endpoint
+_shared_endpoint_providers: dict[str, pulumi_aws.Provider] = {}
+
+
+def _shared_endpoint_provider(
+    endpoint_url: str, region: Optional[Input[str]] = None
+) -> pulumi_aws.Provider:
+    """
+    An endpoint provider shared by all clients without an owning component, named
+    after the endpoint so that its name is stable across deployments
+    """
+    if endpoint_url not in _shared_endpoint_providers:
+        digest = hashlib.md5(endpoint_url.encode()).hexdigest()[:8]
+        _shared_endpoint_providers[endpoint_url] = _endpoint_provider(
+            f"shopkeeper-market-{digest}-provider",
+            endpoint_url=endpoint_url,
+            region=region,
+        )
+    return _shared_endpoint_providers[endpoint_url]
+
 
-def _read_s3_file(region: str, bucket: str, key: str) -> str:
+def _plain_settings(
+    configuration: Any,
+) -> Optional[tuple[Optional[str], tuple[str, ...]]]:
+    """
+    Returns the endpoint url and indexed fields of a market configuration, or None if
+    they are not plain values
+    """
+    if not isinstance(configuration, dict):
+        return None
+    endpoint_url = configuration.get("endpoint_url", None)
+    indexed_fields = configuration.get("indexed_fields", None) or ()
+    if isinstance(endpoint_url, Output) or isinstance(indexed_fields, Output):
+        return None
+    if any(isinstance(field, Output) for field in indexed_fields):
+        return None
+    return endpoint_url, tuple(indexed_fields)
+
+
+def _serialize_metadata(data: Any) -> _SerializedMetadata:
+    """
+    Serializes data with pyserde once, to both yaml (as serde.yaml.to_yaml would)
+    and a dict, and calculates the Etag of the yaml.
+    """
+    data_as_dict = to_dict(data, reuse_instances=False, convert_sets=True)
+    content = YamlSerializer.serialize(data_as_dict)
+    etag = hashlib.md5(content.encode()).hexdigest()
+    return _SerializedMetadata(content=content, etag=etag, data=data_as_dict)
+
+
+def _metadata_value(data: dict[str, Any], field: str) -> str:
+    """
+    Returns data["metadata"][field] as a string, or an empty string if it is not set
+    """
+    metadata = data.get("metadata", None) or {}
+    value = metadata.get(field, None)
+    return "" if value is None else str(value)
+
+
+# market data loaded by clients, shared by all clients of the same market while any
+# of them holds on to it, so a later program in the same process loads it afresh
+_market_data_cache: weakref.WeakValueDictionary[
+    tuple[Optional[str], str, str], AwsMarketV1Data
+] = weakref.WeakValueDictionary()
+
+
+def _load_market_data(
+    region: str, bucket: str, key: str, endpoint_url: Optional[str] = None
+) -> AwsMarketV1Data:
+    """
+    Loads market data from storage once per market, and shares it between all
+    clients of that market that are alive. The result must not be mutated.
+    """
+    cache_key = (endpoint_url, bucket, key)
+    market_data = _market_data_cache.get(cache_key, None)
+    if market_data is None:
+        data = _read_s3_file(
+            region=region, bucket=bucket, key=key, endpoint_url=endpoint_url
+        )
+        market_data = from_yaml(AwsMarketV1Data, data)
+        _market_data_cache[cache_key] = market_data
+    return market_data
+
+
+def _drop_outputs_when_registered(metadata_object: pulumi_s3.BucketObjectv2) -> None:
+    """
+    Drops the output properties of a bucket object once it is registered, apart from
+    its urn and id. Parents keep their children alive for the whole program, and
+    nothing reads the outputs (including the serialized content) back.
+    """
+    # Only safe for objects that never escape the function declaring them
+    # (declare_resource_metadata and AwsMarketV1.__init__), so no caller can read
+    # the dropped outputs. The engine only needs the registration, which completed
+    # before urn resolves, and dependents refer to the object by its urn and id.
+
+    def drop(_):
+        for name, value in list(metadata_object.__dict__.items()):
+            if isinstance(value, Output) and name not in ("urn", "id"):
+                del metadata_object.__dict__[name]
+
+    metadata_object.urn.apply(drop)
+
+
+# error codes of a conditional write that lost to a concurrent write
+_CONFLICT_CODES = ("PreconditionFailed", "ConditionalRequestConflict")
+_MAX_POOL_CONNECTIONS = 64
+
+
+def _get_s3_object(
+    s3: Any, bucket: str, key: str
+) -> tuple[Optional[dict[str, Any]], Optional[str]]:
+    """
+    Returns the parsed yaml content and etag of an object, or (None, None) if it
+    doesn't exist
+    """
+    try:
+        response = s3.get_object(Bucket=bucket, Key=key.lstrip("/"))
+    except ClientError as e:
+        if e.response["Error"]["Code"] in ("NoSuchKey", "404"):
+            return None, None
+        raise
+    content = response["Body"].read().decode("utf-8")
+    return yaml.safe_load(content), response["ETag"].strip('"')
+
+
+def _s3_client(region: str, endpoint_url: Optional[str] = None):
+    """
+    A boto3 S3 client for AWS, or for an S3-compatible endpoint if one is given.
+    The connection pool is sized for the thread pools used by the market client.
+    """
+    if endpoint_url is None:
+        return boto3.client(
+            "s3",
+            region_name=region,
+            config=Config(max_pool_connections=_MAX_POOL_CONNECTIONS),
+        )
+    return boto3.client(
+        "s3",
+        region_name=region,
+        endpoint_url=endpoint_url,
+        config=Config(
+            max_pool_connections=_MAX_POOL_CONNECTIONS,
+            s3={"addressing_style": "path"},
+        ),
+    )
+
+
+def _read_s3_file(
+    region: str, bucket: str, key: str, endpoint_url: Optional[str] = None
+) -> str:
     """
     Read and decode an object from S3
     """
-    s3 = boto3.client("s3", region_name=region)
+    s3 = _s3_client(region=region, endpoint_url=endpoint_url)
     key = key.lstrip("/")
     logger.info(f"fetching {bucket}/{key}")
     response = s3.get_object(Bucket=bucket, Key=key)
@@ -7,6 +7,7 @@ from serde import serde, to_dict
 
 from shopkeeper.aws.market import AwsMarketV1Config
 from shopkeeper.base_producer import Producer, ProducerMetadataV1
+from shopkeeper.profiling import profiled
 
 logger = logging.getLogger(__name__)
 
@@ -42,18 +43,24 @@ class AwsProducerV1(Producer):
 
         key = self.market_client.get_producer_metadata_key(name)
 
-        def prepare_producer_data(d) -> AwsProducerV1Data:
-            producer_data = AwsProducerV1Data(
-                name=name,
-                type=self.__class__.__name__,
-                market=d["market"],
-                metadata=d["metadata"],
+        def prepare_producer_data(d) -> dict[str, Any]:
+            return to_dict(
+                AwsProducerV1Data(
+                    name=name,
+                    type=self.__class__.__name__,
+                    market=d["market"],
+                    metadata=d["metadata"],
+                )
             )
-            return producer_data
 
-        producer_data = Output.all(
+        self.producer_data = Output.all(
             metadata=args["metadata"], market=args["market"]
-        ).apply(prepare_producer_data)
-
-        self.producer_data = producer_data.apply(to_dict)
+        ).apply(
+            profiled(
+                prepare_producer_data,
+                self.__class__.__name__,
+                name,
+                "prepare_producer_data",
+            )
+        )
         self.register_outputs({"producerData": self.producer_data})
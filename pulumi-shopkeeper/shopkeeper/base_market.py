@@ -1,6 +1,12 @@
+import asyncio
 import logging
-from abc import ABC
-from typing import Any, Optional, Type, TypedDict
+import re
+import time
+from abc import ABC, abstractmethod
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Any, AsyncIterator, Iterator, Optional, Sequence, Type, TypedDict
+from urllib.parse import quote, unquote
 
 from pulumi import ComponentResource, Input, Output, ResourceOptions
 
@@ -17,6 +23,30 @@ class MarketMetadataV1(TypedDict):
     environment: Optional[Input[str]]
 
 
+@dataclass
+class ResourceMetadata:
+    """
+    Metadata of a producer or dataset, as read back from a market
+    """
+
+    key: str
+    producer: str
+    dataset: Optional[str]
+    etag: str
+    last_modified: datetime
+    data: dict[str, Any]
+
+
+@dataclass(frozen=True)
+class ResourceMetadataVersion:
+    """
+    The version of a stored metadata object, as returned by a HEAD request
+    """
+
+    etag: str
+    last_modified: datetime
+
+
 class MarketClient(ABC):
     """
     A market client is used by data platform resources to interact with a market.
@@ -24,6 +54,15 @@ class MarketClient(ABC):
 
     market_name: Optional[str] = None
     market_metadata_version: str = "v1"
+    # metadata fields that are indexed when resource metadata is declared
+    indexed_fields: tuple[str, ...] = ()
+
+    _metadata_key_pattern = re.compile(
+        r"/producer=(?P<producer>[^/]+)/(?:dataset=(?P<dataset>[^/]+)/)?metadata-[^/]+$"
+    )
+    _status_key_pattern = re.compile(
+        r"/producer=(?P<producer>[^/]+)/(?:dataset=(?P<dataset>[^/]+)/)?status-[^/]+$"
+    )
 
     def __init__(self, **kwargs):
         pass
@@ -40,9 +79,181 @@ class MarketClient(ABC):
         """
         return f"/shopkeeper/market={self.market_name}/producer={producer_name}/dataset={dataset_name}/metadata-{self.market_metadata_version}.json"
 
+    def get_producer_status_key(self, producer_name):
+        """
+        Returns the key of a producer's status, which is written directly rather than
+        declared with Pulumi, next to the producer metadata file
+        """
+        return f"/shopkeeper/market={self.market_name}/producer={producer_name}/status-{self.market_metadata_version}.json"
+
+    def get_dataset_status_key(self, producer_name, dataset_name):
+        """
+        Returns the key of a dataset's status, which is written directly rather than
+        declared with Pulumi, next to the dataset metadata file
+        """
+        return f"/shopkeeper/market={self.market_name}/producer={producer_name}/dataset={dataset_name}/status-{self.market_metadata_version}.json"
+
+    def is_status_key(self, key) -> bool:
+        """
+        Returns whether key is the key of a producer or dataset status
+        """
+        return self._status_key_pattern.search(key) is not None
+
     def get_market_metadata_key(self):
         return Market.get_market_metadata_key(self.market_name)
 
+    def get_resource_metadata_prefix(self):
+        """
+        Returns the key prefix under which all producer and dataset metadata is stored
+        """
+        return f"/shopkeeper/market={self.market_name}/producer="
+
+    def parse_resource_metadata_key(self, key) -> Optional[tuple[str, Optional[str]]]:
+        """
+        Returns (producer name, dataset name or None) for a producer or dataset
+        metadata key, or None for any other key
+        """
+        match = self._metadata_key_pattern.search(key)
+        if match is None:
+            return None
+        return match["producer"], match["dataset"]
+
+    @abstractmethod
+    def iter_resource_metadata(
+        self, batch_size: int = 1000
+    ) -> Iterator[ResourceMetadata]:
+        """
+        Yields the metadata of all producers and datasets in the market, reading
+        batch_size objects at a time
+        """
+
+    def export_record_batches(self, batch_size: int = 1000):
+        """
+        Yields all producer and dataset metadata as pyarrow RecordBatches of up to
+        batch_size rows, with the catalog schema of shopkeeper.export.
+        """
+        from shopkeeper.export import to_record_batches
+
+        records = self.iter_resource_metadata(batch_size=batch_size)
+        yield from to_record_batches(records, batch_size=batch_size)
+
+    def export_to_arrow(self, batch_size: int = 1000):
+        """
+        Returns all producer and dataset metadata as a pyarrow Table
+        """
+        from shopkeeper.export import to_table
+
+        return to_table(self.export_record_batches(batch_size=batch_size))
+
+    def export_to_parquet(self, path: str, batch_size: int = 1000) -> int:
+        """
+        Streams all producer and dataset metadata to a Parquet file at path, holding
+        at most one batch in memory. Returns the number of rows written.
+        """
+        from shopkeeper.export import write_parquet
+
+        return write_parquet(self.export_record_batches(batch_size=batch_size), path)
+
+    @abstractmethod
+    def head_resource_metadata(
+        self, keys: Sequence[str], max_workers: int = 32
+    ) -> dict[str, Optional[ResourceMetadataVersion]]:
+        """
+        Returns the current version of each key, or None if it doesn't exist
+        """
+
+    def poll_resource_metadata(
+        self,
+        keys: Sequence[str],
+        versions: dict[str, Optional[ResourceMetadataVersion]],
+        max_workers: int = 32,
+    ) -> list[str]:
+        """
+        Returns the keys whose version differs from versions (created, changed or
+        deleted), and updates versions to the current versions
+        """
+        current = self.head_resource_metadata(keys, max_workers=max_workers)
+        changed = [
+            key
+            for key, version in current.items()
+            if key not in versions or versions[key] != version
+        ]
+        versions.update(current)
+        return changed
+
+    def watch_resource_metadata(
+        self,
+        keys: Sequence[str],
+        interval: float = 60.0,
+        max_workers: int = 32,
+        versions: Optional[dict[str, Optional[ResourceMetadataVersion]]] = None,
+    ) -> Iterator[str]:
+        """
+        Polls the versions of keys every interval seconds, and yields each key that
+        changed. Pass versions to compare against a previously known table (it is
+        updated in place); otherwise the first poll only records the current versions.
+        """
+        if versions is None:
+            versions = {}
+            self.poll_resource_metadata(keys, versions, max_workers=max_workers)
+            time.sleep(interval)
+        while True:
+            start = time.monotonic()
+            yield from self.poll_resource_metadata(
+                keys, versions, max_workers=max_workers
+            )
+            time.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+    async def awatch_resource_metadata(
+        self,
+        keys: Sequence[str],
+        interval: float = 60.0,
+        max_workers: int = 32,
+        versions: Optional[dict[str, Optional[ResourceMetadataVersion]]] = None,
+    ) -> AsyncIterator[str]:
+        """
+        Async version of watch_resource_metadata. Polls run in a worker thread.
+        """
+        if versions is None:
+            versions = {}
+            await asyncio.to_thread(
+                self.poll_resource_metadata, keys, versions, max_workers
+            )
+            await asyncio.sleep(interval)
+        while True:
+            start = time.monotonic()
+            changed = await asyncio.to_thread(
+                self.poll_resource_metadata, keys, versions, max_workers
+            )
+            for key in changed:
+                yield key
+            await asyncio.sleep(max(0.0, interval - (time.monotonic() - start)))
+
+    def get_index_field_prefix(self, field):
+        """
+        Returns the key prefix under which all values of metadata field are indexed
+        """
+        return f"/shopkeeper/market={self.market_name}/index/{field}="
+
+    def get_index_prefix(self, field, value):
+        """
+        Returns the key prefix under which all keys with metadata field == value are
+        indexed
+        """
+        return f"{self.get_index_field_prefix(field)}{quote(str(value), safe='')}/"
+
+    def get_index_key(self, field, value, key):
+        """
+        Returns the key of the index entry pointing at key, for metadata field == value
+        """
+        return self.get_index_prefix(field, value) + quote(key, safe="")
+
+    def get_key_from_index_key(self, index_key):
+        """
+        Returns the key that an index entry points at
+        """
+        return unquote(index_key.rsplit("/", 1)[-1])
+
 
 class Market(ComponentResource, ABC):
     """
@@ -120,7 +331,9 @@ class MarketFactory:
     def get_configuration(self, market_type: str):
         return self._configurations[market_type]
 
-    def configure_client(self, market_type, market_configuration) -> MarketClient:
+    def configure_client(
+        self, market_type, market_configuration, **kwargs
+    ) -> MarketClient:
         MC = self._clients[market_type]
-        mc = MC(market_configuration=market_configuration)
+        mc = MC(market_configuration=market_configuration, **kwargs)
         return mc
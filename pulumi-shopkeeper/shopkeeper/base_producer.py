@@ -42,5 +42,8 @@ class Producer(ComponentResource):
 
         # configure client
         self.market_client = market_factory.configure_client(
-            market_type=self.market_type, market_configuration=args["market"]
+            market_type=self.market_type,
+            market_configuration=args["market"],
+            name=name,
+            opts=ResourceOptions(parent=self),
         )
@@ -0,0 +1,85 @@
+"""
+Export of a market's catalog (producer and dataset metadata) to Arrow and Parquet.
+
+The fixed fields of resource metadata (AwsProducerV1Data) are stored as columns, and
+free-form metadata as JSON strings, which DuckDB and friends can query directly.
+Requires pyarrow (`poetry install --extras export`).
+"""
+
+import json
+from typing import Any, Iterable, Iterator, Optional
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from shopkeeper.base_market import ResourceMetadata
+
+CATALOG_SCHEMA = pa.schema(
+    [
+        pa.field("key", pa.string(), nullable=False),
+        pa.field("kind", pa.dictionary(pa.int8(), pa.string()), nullable=False),
+        pa.field("producer", pa.string(), nullable=False),
+        pa.field("dataset", pa.string()),
+        pa.field("etag", pa.string()),
+        pa.field("last_modified", pa.timestamp("ms", tz="UTC")),
+        pa.field("name", pa.string()),
+        pa.field("type", pa.dictionary(pa.int32(), pa.string())),
+        pa.field("market", pa.dictionary(pa.int32(), pa.string())),  # json
+        pa.field("metadata", pa.string()),  # json
+    ]
+)
+
+
+def _to_json(value: Any) -> Optional[str]:
+    if value is None:
+        return None
+    return json.dumps(value, sort_keys=True, default=str)
+
+
+def _to_record_batch(records: list[ResourceMetadata]) -> pa.RecordBatch:
+    columns: dict[str, list[Any]] = {field.name: [] for field in CATALOG_SCHEMA}
+    for r in records:
+        data = r.data if isinstance(r.data, dict) else {}
+        columns["key"].append(r.key)
+        columns["kind"].append("producer" if r.dataset is None else "dataset")
+        columns["producer"].append(r.producer)
+        columns["dataset"].append(r.dataset)
+        columns["etag"].append(r.etag)
+        columns["last_modified"].append(r.last_modified)
+        columns["name"].append(data.get("name", None))
+        columns["type"].append(data.get("type", None))
+        columns["market"].append(_to_json(data.get("market", None)))
+        columns["metadata"].append(_to_json(data.get("metadata", None)))
+    return pa.RecordBatch.from_pydict(columns, schema=CATALOG_SCHEMA)
+
+
+def to_record_batches(
+    records: Iterable[ResourceMetadata], batch_size: int = 1000
+) -> Iterator[pa.RecordBatch]:
+    """
+    Yields RecordBatches of up to batch_size records with the CATALOG_SCHEMA
+    """
+    batch: list[ResourceMetadata] = []
+    for record in records:
+        batch.append(record)
+        if len(batch) >= batch_size:
+            yield _to_record_batch(batch)
+            batch = []
+    if batch:
+        yield _to_record_batch(batch)
+
+
+def to_table(batches: Iterable[pa.RecordBatch]) -> pa.Table:
+    return pa.Table.from_batches(batches, schema=CATALOG_SCHEMA)
+
+
+def write_parquet(batches: Iterable[pa.RecordBatch], path: str) -> int:
+    """
+    Writes batches to a Parquet file one at a time. Returns the number of rows.
+    """
+    rows = 0
+    with pq.ParquetWriter(path, CATALOG_SCHEMA) as writer:
+        for batch in batches:
+            writer.write_batch(batch)
+            rows += batch.num_rows
+    return rows
@@ -0,0 +1,132 @@
+"""
+Profiling of the Output.apply callbacks that components chain together.
+
+Enable by setting SHOPKEEPER_PROFILE=1. Each wrapped callback is then timed per
+component, and the callbacks with the highest cumulative cost over the whole
+program are logged when the program exits, along with the memory high-water mark.
+"""
+
+import atexit
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import Any, Callable, Optional, TypeVar
+
+logger = logging.getLogger(__name__)
+
+PROFILE_ENV_VAR = "SHOPKEEPER_PROFILE"
+
+T = TypeVar("T")
+
+
+@dataclass
+class CallbackStats:
+    """
+    Cumulative timings of one apply callback
+    """
+
+    calls: int = 0
+    seconds: float = 0.0
+
+
+# (component type, component name, step) -> stats
+_stats: dict[tuple[str, str, str], CallbackStats] = defaultdict(CallbackStats)
+_report_registered = False
+
+
+def is_enabled() -> bool:
+    return os.environ.get(PROFILE_ENV_VAR, "") not in ("", "0", "false")
+
+
+def profiled(
+    fn: Callable[..., T], component_type: str, component_name: str, step: str
+) -> Callable[..., T]:
+    """
+    Returns fn, timed as step of the component when profiling is enabled.
+    Wrap apply callbacks with it, e.g. `output.apply(profiled(fn, typ, name, "fn"))`.
+    """
+    if not is_enabled():
+        return fn
+
+    global _report_registered
+    if not _report_registered:
+        atexit.register(log_report)
+        _report_registered = True
+
+    key = (component_type, component_name, step)
+
+    def timed(*args: Any, **kwargs: Any) -> T:
+        start = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            stats = _stats[key]
+            stats.calls += 1
+            stats.seconds += time.perf_counter() - start
+
+    return timed
+
+
+def component_timings(component_name: str) -> dict[str, CallbackStats]:
+    """
+    Returns the timings of each profiled callback of a component, by step
+    """
+    return {
+        step: stats
+        for (_, name, step), stats in _stats.items()
+        if name == component_name
+    }
+
+
+def top_callbacks(limit: int = 10) -> list[tuple[str, str, CallbackStats]]:
+    """
+    Returns the callbacks with the highest cumulative cost over the program, summed
+    over all components of the same type, as (component type, step, stats)
+    """
+    totals: dict[tuple[str, str], CallbackStats] = defaultdict(CallbackStats)
+    for (typ, _, step), stats in _stats.items():
+        total = totals[(typ, step)]
+        total.calls += stats.calls
+        total.seconds += stats.seconds
+    ranked = sorted(totals.items(), key=lambda item: item[1].seconds, reverse=True)
+    return [(typ, step, stats) for (typ, step), stats in ranked[:limit]]
+
+
+def memory_high_water_mark() -> Optional[int]:
+    """
+    Returns the peak resident memory of this process, in bytes, or None where it is
+    not available (the resource module is Unix-only)
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def log_report(limit: int = 10) -> None:
+    """
+    Logs the callbacks with the highest cumulative cost over the program, and the
+    memory high-water mark
+    """
+    lines = [f"{'component':<24} {'step':<24} {'calls':>8} {'total ms':>10}"]
+    for typ, step, stats in top_callbacks(limit):
+        lines.append(
+            f"{typ:<24} {step:<24} {stats.calls:>8} {stats.seconds * 1000:>10.2f}"
+        )
+    logger.info("Most expensive apply callbacks:\n" + "\n".join(lines))
+    peak = memory_high_water_mark()
+    if peak is not None:
+        logger.info(f"Memory high-water mark: {peak / 2**20:.1f} MiB")
+
+
+def reset() -> None:
+    """
+    Forgets all timings
+    """
+    _stats.clear()
@@ -0,0 +1,120 @@
+import argparse
+import logging
+import os
+import time
+
+import pulumi
+from pulumi import ResourceOptions
+from pulumi import automation as auto
+
+from shopkeeper.aws.market import AwsMarketV1, AwsMarketV1Args, MarketMetadataV1
+from shopkeeper.aws.producer import AwsProducerV1, AwsProducerV1Args
+from shopkeeper.base_producer import ProducerMetadataV1
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("load-test-markets")
+
+PROJECT_NAME = "load-test"
+# operations of an update that count towards its throughput
+CHANGE_OPS = ("create", "update", "replace")
+
+
+def load_program(n_markets: int, n_producers: int, n_datasets: int, endpoint_url):
+    """
+    Returns an inline program declaring n_markets markets, each with n_producers
+    producers, each declaring n_datasets dataset metadata objects.
+    """
+
+    def declare_markets():
+        for i in range(n_markets):
+            market = AwsMarketV1(
+                name=f"load-market-{i}",
+                args=AwsMarketV1Args(
+                    metadata=MarketMetadataV1(
+                        description="load test market",
+                        color="grey",
+                        environment="dev",
+                    ),
+                    bucket_prefix=f"load-market-{i}",
+                    endpoint_url=endpoint_url,
+                ),
+                opts=None,
+            )
+            market_configuration = dict(
+                market_type="AwsMarketV1",
+                bucket=market.market_configuration["bucket"],
+                region=market.market_configuration["region"],
+                market_metadata_key=market.market_configuration["market_metadata_key"],
+                endpoint_url=endpoint_url,
+            )
+            for j in range(n_producers):
+                producer_name = f"load-producer-{i}-{j}"
+                producer = AwsProducerV1(
+                    name=producer_name,
+                    args=AwsProducerV1Args(
+                        metadata=ProducerMetadataV1(
+                            name=producer_name, description="load test producer"
+                        ),
+                        market=market_configuration,  # type: ignore
+                    ),
+                )
+                client = producer.market_client
+                for k in range(n_datasets):
+                    dataset_name = f"dataset-{k}"
+                    client.declare_resource_metadata(
+                        data=pulumi.Output.from_input(
+                            {"name": dataset_name, "producer": producer_name}
+                        ),
+                        key=client.get_dataset_metadata_key(
+                            producer_name, dataset_name
+                        ),
+                        name=f"{producer_name}-{dataset_name}",
+                        opts=ResourceOptions(parent=producer),
+                    )
+
+    return declare_markets
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure registration throughput of markets, producers and "
+        "datasets against an S3-compatible endpoint (moto server, MinIO, ...)"
+    )
+    parser.add_argument("--markets", type=int, default=1)
+    parser.add_argument("--producers", type=int, default=10)
+    parser.add_argument("--datasets", type=int, default=10)
+    parser.add_argument(
+        "--endpoint-url", default=os.environ.get("SHOPKEEPER_ENDPOINT_URL")
+    )
+    parser.add_argument("--destroy", action="store_true")
+    args = parser.parse_args()
+
+    stack_name = f"load-{args.markets}x{args.producers}x{args.datasets}"
+    stack = auto.create_or_select_stack(
+        stack_name=stack_name,
+        project_name=PROJECT_NAME,
+        program=load_program(
+            args.markets, args.producers, args.datasets, args.endpoint_url
+        ),
+    )
+    logger.info(f"🏋️ Updating stack {stack_name} against {args.endpoint_url}...")
+    start = time.perf_counter()
+    up_result = stack.up()
+    elapsed = time.perf_counter() - start
+
+    # resources left unchanged by a previous run of the stack don't count
+    changes = up_result.summary.resource_changes or {}
+    n_resources = sum(changes.get(op, 0) for op in CHANGE_OPS)
+    logger.info(f"update summary: {changes}")
+    logger.info(
+        f"⏱️ {n_resources} resources changed in {elapsed:.1f}s "
+        f"({n_resources / elapsed:.1f} resources/s)"
+    )
+
+    if args.destroy:
+        stack.destroy()
+        logger.info(f"🪦 Destroyed stack {stack_name}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,6 @@
 import logging
+import os
+from urllib.parse import quote
 
 import pulumi
 import pytest
@@ -8,7 +10,7 @@ from shopkeeper.aws.producer import AwsMarketV1Config, AwsProducerV1, AwsProduce
 from shopkeeper.base_producer import ProducerMetadataV1
 from shopkeeper.factory import market_factory
 
-from .test_programs import pulumi_up_for_test_programs
+from .test_programs import pulumi_up_for_test_programs, requires_aws
 
 logger = logging.getLogger(__name__)
 
@@ -26,8 +28,11 @@ def some_market_outputs(pytestconfig) -> dict[str, str]:
             environment="dev",
         ),
         bucket_prefix="pytest-some-red-market",
+        endpoint_url=os.environ.get("SHOPKEEPER_ENDPOINT_URL"),
     )
-    cache_key = f"{market_type}/{name}"
+    # outputs of a market on aws are not valid against a local endpoint
+    endpoint = quote(args["endpoint_url"] or "aws", safe="")
+    cache_key = f"{market_type}/{name}/{endpoint}"
 
     # read from cache
     outputs = pytestconfig.cache.get(cache_key, None)
@@ -112,11 +117,13 @@ def aws_test_market_output(pytestconfig):
     return outputs
 
 
+@requires_aws
 def test_yaml_market(aws_test_market_output):
     assert "someMarketData" in aws_test_market_output
     assert "someMarketConfiguration" in aws_test_market_output
 
 
+@requires_aws
 def test_yaml_producer(aws_test_market_output):
     stack_name = "aws_test_producer"
     up_result = pulumi_up_for_test_programs(
@@ -0,0 +1,411 @@
+import asyncio
+import dataclasses
+import gc
+import json
+import logging
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pulumi
+import pytest
+import yaml
+from botocore.exceptions import ClientError
+from moto.server import ThreadedMotoServer
+from pulumi import Output
+from pulumi.runtime.settings import get_monitor
+from pulumi.runtime.sync_await import _sync_await
+from serde.yaml import to_yaml
+
+from shopkeeper.aws.market import (
+    AwsMarketV1,
+    AwsMarketV1Client,
+    AwsMarketV1Config,
+    AwsMarketV1Data,
+    _load_market_data,
+    _s3_client,
+)
+from shopkeeper.aws.producer import AwsProducerV1Data
+from shopkeeper.base_market import Market, ResourceMetadataVersion
+
+logger = logging.getLogger(__name__)
+
+REGION = "eu-west-1"
+
+
+class RecordingMocks(pulumi.runtime.Mocks):
+    """
+    Mocks that echo inputs back as outputs, and record the declared resources
+    """
+
+    def __init__(self):
+        self.resources = []
+
+    def new_resource(self, args):
+        self.resources.append(args)
+        outputs = dict(args.inputs)
+        if args.typ == "aws:s3/bucketV2:BucketV2":
+            bucket = f"{args.inputs['bucketPrefix']}-0001"
+            outputs.update(bucket=bucket, region=REGION, arn=f"arn:aws:s3:::{bucket}")
+        return [f"{args.name}_id", outputs]
+
+    def call(self, args):
+        return {}
+
+
+@pytest.fixture(scope="module")
+def local_endpoint_url():
+    """
+    A moto server standing in for S3, so client tests run without cloud access
+    """
+    with pytest.MonkeyPatch.context() as mp:
+        mp.setenv("AWS_ACCESS_KEY_ID", "testing")
+        mp.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+        server = ThreadedMotoServer(ip_address="127.0.0.1", port=0)
+        server.start()
+        host, port = server.get_host_and_port()
+        yield f"http://{host}:{port}"
+        server.stop()
+
+
+@pytest.fixture()
+def local_market_configuration(local_endpoint_url, request) -> AwsMarketV1Config:
+    name = re.sub(r"[^a-z0-9]+", "-", f"local-{request.node.name}".lower())
+    name = name[:40].strip("-")
+    key = Market.get_market_metadata_key(name=name)
+    s3 = _s3_client(region=REGION, endpoint_url=local_endpoint_url)
+    s3.create_bucket(
+        Bucket=name, CreateBucketConfiguration={"LocationConstraint": REGION}
+    )
+    configuration = AwsMarketV1Config(
+        market_type="AwsMarketV1",
+        bucket=name,
+        region=REGION,
+        market_metadata_key=key,
+        endpoint_url=local_endpoint_url,
+    )
+    market_data = AwsMarketV1Data(
+        market_type="AwsMarketV1",
+        name=name,
+        metadata={"description": "local market"},
+        configuration=dict(configuration),
+        region=REGION,
+        bucket=name,
+        bucket_arn=f"arn:aws:s3:::{name}",
+    )
+    s3.put_object(Bucket=name, Key=key.lstrip("/"), Body=to_yaml(market_data))
+    return configuration
+
+
+def test_local_market_client(local_market_configuration):
+    client = AwsMarketV1Client(market_configuration=local_market_configuration)
+
+    def check_client_market_data(d):
+        assert d.market_type == "AwsMarketV1"
+        assert d.bucket == local_market_configuration["bucket"]
+        assert (
+            d.configuration["endpoint_url"]
+            == local_market_configuration["endpoint_url"]
+        )
+
+    checks = client.market_data.apply(check_client_market_data)
+    _sync_await(checks._future)
+
+
+def test_market_data_shared_while_used(local_market_configuration, local_endpoint_url):
+    c = local_market_configuration
+    load = dict(
+        region=c["region"],
+        bucket=c["bucket"],
+        key=c["market_metadata_key"],
+        endpoint_url=c["endpoint_url"],
+    )
+    market_data = _load_market_data(**load)
+    assert _load_market_data(**load) is market_data
+
+    # a later program in the same process sees changes to the market
+    s3 = _s3_client(region=REGION, endpoint_url=local_endpoint_url)
+    changed = dataclasses.replace(market_data, metadata={"description": "changed"})
+    s3.put_object(
+        Bucket=c["bucket"], Key=load["key"].lstrip("/"), Body=to_yaml(changed)
+    )
+    del market_data
+    gc.collect()
+    assert _load_market_data(**load).metadata == {"description": "changed"}
+
+
+def test_output_market_configuration(local_market_configuration):
+    # as passed from stack reference outputs, with a plain endpoint and index fields
+    configuration = {
+        k: v if k == "endpoint_url" else Output.from_input(v)
+        for k, v in local_market_configuration.items()
+    }
+    configuration["indexed_fields"] = ["environment"]
+    mocks = RecordingMocks()
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    pulumi.runtime.set_mocks(mocks, preview=False)
+
+    @pulumi.runtime.test
+    def declare_metadata():
+        owner = pulumi.ComponentResource("test:index:Owner", "pete")
+        client = AwsMarketV1Client(
+            market_configuration=configuration,
+            name="pete",
+            opts=pulumi.ResourceOptions(parent=owner),
+        )
+        key = client.get_dataset_metadata_key("pete", "pumpkins")
+        data = Output.from_input({"metadata": {"environment": "prod"}})
+
+        # which resources to declare can't depend on unknown values
+        unknown = AwsMarketV1Client(Output.from_input(local_market_configuration))
+        with pytest.raises(ValueError):
+            unknown.declare_resource_metadata(data, key=key, name="unknown")
+
+        return client.declare_resource_metadata(data, key=key, name="pumpkins")
+
+    declare_metadata()
+    by_name = {r.name: r for r in mocks.resources}
+    index_key = by_name["pumpkins-index-environment"].inputs["key"]
+    assert "/index/environment=prod/" in index_key
+    (provider,) = [r for r in mocks.resources if r.typ == "pulumi:providers:aws"]
+    assert provider.name == "pete-market-provider"
+    assert any(
+        urn.endswith("Owner$pulumi:providers:aws::pete-market-provider")
+        for urn in get_monitor().resources
+    )
+    endpoint_url = local_market_configuration["endpoint_url"]
+    endpoints = json.loads(provider.inputs["endpoints"])
+    assert endpoints == [{"s3": endpoint_url, "sts": endpoint_url}]
+    assert provider.name in by_name["pumpkins-metadata"].provider
+    assert provider.name in by_name["pumpkins-index-environment"].provider
+    assert "unknown-metadata" not in by_name
+
+
+def test_market_endpoint_provider(local_endpoint_url):
+    asyncio.set_event_loop(asyncio.new_event_loop())
+    pulumi.runtime.set_mocks(RecordingMocks(), preview=False)
+
+    @pulumi.runtime.test
+    def declare_market():
+        market = AwsMarketV1(
+            "veg",
+            args={
+                "metadata": {"description": "local market"},
+                "bucket_prefix": "veg",
+                "endpoint_url": local_endpoint_url,
+            },
+            opts=None,
+        )
+        return market.urn
+
+    declare_market()
+    assert any(
+        urn.endswith("AwsMarketV1$pulumi:providers:aws::veg-provider")
+        for urn in get_monitor().resources
+    )
+
+
+def test_query_metadata_keys(local_market_configuration, local_endpoint_url):
+    client = AwsMarketV1Client(market_configuration=local_market_configuration)
+    s3 = _s3_client(region=REGION, endpoint_url=local_endpoint_url)
+    bucket = local_market_configuration["bucket"]
+    keys = {
+        client.get_producer_metadata_key("pete"): "prod",
+        client.get_producer_metadata_key("paula"): "dev",
+        client.get_dataset_metadata_key("pete", "pumpkins"): "prod",
+    }
+    for key, environment in keys.items():
+        index_key = client.get_index_key("environment", environment, key)
+        s3.put_object(Bucket=bucket, Key=index_key.lstrip("/"), Body=key)
+
+    prod_keys = client.query_metadata_keys("environment", "prod")
+    assert sorted(prod_keys) == sorted(k for k, e in keys.items() if e == "prod")
+    assert client.query_metadata_keys("environment", "test") == []
+
+
+def test_export_to_parquet(local_market_configuration, local_endpoint_url, tmp_path):
+    pq = pytest.importorskip("pyarrow.parquet")
+    client = AwsMarketV1Client(market_configuration=local_market_configuration)
+    s3 = _s3_client(region=REGION, endpoint_url=local_endpoint_url)
+    bucket = local_market_configuration["bucket"]
+    for producer_name in ("pete", "paula", "pam"):
+        producer_data = AwsProducerV1Data(
+            name=producer_name,
+            type="AwsProducerV1",
+            metadata={"name": producer_name, "description": "some producer"},
+            market=dict(local_market_configuration),
+        )
+        key = client.get_producer_metadata_key(producer_name)
+        s3.put_object(Bucket=bucket, Key=key.lstrip("/"), Body=to_yaml(producer_data))
+        key = client.get_dataset_metadata_key(producer_name, "pumpkins")
+        s3.put_object(Bucket=bucket, Key=key.lstrip("/"), Body="metadata: {}")
+
+    path = tmp_path / "catalog.parquet"
+    rows = client.export_to_parquet(str(path), batch_size=2)
+    assert rows == 6
+
+    table = pq.read_table(path)
+    assert table.num_rows == 6
+    kinds = table.column("kind").to_pylist()
+    assert kinds.count("producer") == 3
+    assert kinds.count("dataset") == 3
+    assert sorted(set(table.column("producer").to_pylist())) == ["pam", "paula", "pete"]
+    assert client.export_to_arrow().num_rows == 6
+
+
+def test_iter_resource_metadata_skips_deleted(local_market_configuration, monkeypatch):
+    client = AwsMarketV1Client(market_configuration=local_market_configuration)
+    s3, bucket = client._s3()
+    keys = [client.get_producer_metadata_key(p).lstrip("/") for p in ("pam", "pete")]
+    for key in keys:
+        s3.put_object(Bucket=bucket, Key=key, Body="metadata: {}")
+
+    # pam is deleted after the objects are listed, but before it is read
+    get_object = s3.get_object
+
+    def get_object_after_delete(**kwargs):
+        if kwargs["Key"] == keys[0]:
+            s3.delete_object(Bucket=bucket, Key=keys[0])
+        return get_object(**kwargs)
+
+    monkeypatch.setattr(s3, "get_object", get_object_after_delete)
+    assert [r.key for r in client.iter_resource_metadata()] == keys[1:]
+
+
+def test_conditional_writes(local_market_configuration):
+    client = AwsMarketV1Client(market_configuration=local_market_configuration)
+    key = client.get_dataset_status_key("pete", "pumpkins")
+
+    # metadata declared with pulumi is not written directly
+    with pytest.raises(ValueError):
+        client.put_resource_status(
+            client.get_dataset_metadata_key("pete", "pumpkins"), {"metadata": {}}
+        )
+
+    etag = client.put_resource_status(key, {"metadata": {"row_count": 1}})
+    with pytest.raises(ClientError) as e:
+        client.put_resource_status(key, {"metadata": {"row_count": 2}})
+    assert e.value.response["Error"]["Code"] == "PreconditionFailed"
+
+    client.put_resource_status(key, {"metadata": {"row_count": 2}}, if_match=etag)
+    with pytest.raises(ClientError):
+        client.put_resource_status(key, {"metadata": {"row_count": 3}}, if_match=etag)
+
+
+def test_concurrent_updates(local_market_configuration):
+    client = AwsMarketV1Client(
+        market_configuration=dict(
+            local_market_configuration, indexed_fields=["environment"]
+        )
+    )
+    key = client.get_dataset_status_key("pete", "pumpkins")
+
+    environments = ("dev", "prod", "staging")
+
+    def increment(d):
+        count = 1 + (0 if d is None else d["metadata"]["row_count"])
+        environment = environments[count % 3]
+        return {"metadata": {"row_count": count, "environment": environment}}
+
+    def indexed_environments():
+        return [e for e in environments if client.query_metadata_keys("environment", e)]
+
+    client._s3()
+    with ThreadPoolExecutor(max_workers=4) as pool:
+        futures = [
+            pool.submit(client.update_resource_status, key, increment, 50)
+            for _ in range(20)
+        ]
+        for future in futures:
+            future.result()
+    # concurrent writers moving the index entry don't leave stale entries behind
+    assert indexed_environments() == ["staging"]
+
+    etags = client.update_resource_status_batch({key: increment})
+    s3, bucket = client._s3()
+    response = s3.get_object(Bucket=bucket, Key=key.lstrip("/"))
+    assert response["ETag"].strip('"') == etags[key]
+    assert yaml.safe_load(response["Body"].read())["metadata"]["row_count"] == 21
+    assert client.query_metadata_keys("environment", "dev") == [key]
+    assert indexed_environments() == ["dev"]
+
+
+def test_reconcile_index_entries(local_market_configuration):
+    client = AwsMarketV1Client(
+        market_configuration=dict(
+            local_market_configuration, indexed_fields=["environment"]
+        )
+    )
+    s3, bucket = client._s3()
+    key = client.get_dataset_status_key("pete", "pumpkins")
+    metadata_key = client.get_dataset_metadata_key("pete", "pumpkins")
+    # left behind by an interrupted writer, and declared by pulumi for the metadata
+    for environment, indexed_key in [
+        ("prod", key),
+        ("staging", key),
+        ("prod", metadata_key),
+    ]:
+        index_key = client.get_index_key("environment", environment, indexed_key)
+        s3.put_object(Bucket=bucket, Key=index_key.lstrip("/"), Body=indexed_key)
+
+    client.update_resource_status(key, lambda d: {"metadata": {"environment": "dev"}})
+    assert client.query_metadata_keys("environment", "dev") == [key]
+    assert client.query_metadata_keys("environment", "prod") == [metadata_key]
+    assert client.query_metadata_keys("environment", "staging") == []
+
+
+def test_reconcile_index_entries_gives_up(local_market_configuration, monkeypatch):
+    client = AwsMarketV1Client(
+        market_configuration=dict(
+            local_market_configuration, indexed_fields=["environment"]
+        )
+    )
+    key = client.get_dataset_status_key("pete", "pumpkins")
+    client.update_resource_status(key, lambda d: {"metadata": {"environment": "dev"}})
+
+    # as if another writer changed the status during every attempt
+    heads = []
+
+    def head_resource_metadata(keys, max_workers=32):
+        heads.append(keys)
+        return {
+            k: ResourceMetadataVersion(etag=str(len(heads)), last_modified=None)
+            for k in keys
+        }
+
+    monkeypatch.setattr(client, "head_resource_metadata", head_resource_metadata)
+    client._reconcile_index_entries(key, max_attempts=3)
+    assert len(heads) == 3
+    assert client.query_metadata_keys("environment", "dev") == [key]
+
+
+def test_watch_resource_metadata(local_market_configuration):
+    client = AwsMarketV1Client(
+        market_configuration=dict(
+            local_market_configuration, indexed_fields=["environment"]
+        )
+    )
+    s3, bucket = client._s3()
+    keys = [client.get_dataset_status_key("pete", d) for d in ("a", "b", "c")]
+    for key in keys[:2]:
+        client.put_resource_status(key, {"metadata": {"environment": "dev"}})
+    assert sorted(client.query_metadata_keys("environment", "dev")) == keys[:2]
+
+    versions = {}
+    assert client.poll_resource_metadata(keys, versions) == keys
+    assert versions[keys[2]] is None
+    assert client.poll_resource_metadata(keys, versions) == []
+
+    client.update_resource_status(keys[0], lambda d: {"metadata": {"row_count": 2}})
+    s3.delete_object(Bucket=bucket, Key=keys[1].lstrip("/"))
+    assert client.poll_resource_metadata(keys, versions) == keys[:2]
+
+    watch = client.watch_resource_metadata(keys, interval=0, versions=versions)
+    client.update_resource_status(keys[2], lambda d: {"metadata": {"row_count": 1}})
+    assert next(watch) == keys[2]
+
+    async def first_change():
+        awatch = client.awatch_resource_metadata(keys, interval=0, versions=versions)
+        client.update_resource_status(keys[0], lambda d: {"metadata": {}})
+        return await anext(awatch)
+
+    assert asyncio.run(first_change()) == keys[0]
@@ -1,6 +1,7 @@
 import logging
 import os
 from typing import Any
+from urllib.parse import quote
 
 import pulumi
 import pytest
@@ -13,7 +14,8 @@ logger = logging.getLogger(__name__)
 
 
 def test_environment():
-    assert "AWS_PROFILE" in os.environ
+    # either real AWS, or a local S3-compatible endpoint such as moto server
+    assert "AWS_PROFILE" in os.environ or "SHOPKEEPER_ENDPOINT_URL" in os.environ
 
 
 @pytest.fixture(
@@ -28,6 +30,7 @@ def test_environment():
                     environment="dev",
                 ),
                 bucket_prefix="pytest-some-market",
+                endpoint_url=os.environ.get("SHOPKEEPER_ENDPOINT_URL"),
             ),
             opts=None,
         ),
@@ -53,7 +56,9 @@ def some_market_outputs(some_market_inputs, pytestconfig) -> dict[str, Any]:
     market_type = some_market_inputs["market_type"]
     name = some_market_inputs["name"]
     args = some_market_inputs["args"]
-    cache_key = f"{market_type}/{name}"
+    # outputs of a market on aws are not valid against a local endpoint
+    endpoint = quote(args["endpoint_url"] or "aws", safe="")
+    cache_key = f"{market_type}/{name}/{endpoint}"
 
     # read from cache
     outputs = pytestconfig.cache.get(cache_key, None)
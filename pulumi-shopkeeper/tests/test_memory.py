@@ -0,0 +1,139 @@
+import asyncio
+import gc
+import logging
+import tracemalloc
+
+import boto3
+import pulumi
+import pytest
+from moto import mock_aws
+from pulumi import ResourceOptions
+from pulumi.runtime.settings import get_monitor
+from pulumi.runtime.sync_await import _sync_await
+from pulumi_aws import s3 as pulumi_s3
+from serde.yaml import to_yaml
+
+from shopkeeper.aws.market import AwsMarketV1Data, _drop_outputs_when_registered
+from shopkeeper.aws.producer import AwsProducerV1
+
+logger = logging.getLogger(__name__)
+
+REGION = "us-east-1"
+BUCKET = "memory-test-market"
+MARKET_METADATA_SIZE = 100_000
+DATASET_METADATA_SIZE = 5_000
+N_DATASETS = 3
+
+
+class EchoMocks(pulumi.runtime.Mocks):
+    """
+    Mocks that echo inputs back as outputs, like the aws provider does
+    """
+
+    def new_resource(self, args):
+        return [f"{args.name}_id", dict(args.inputs)]
+
+    def call(self, args):
+        return {}
+
+
+@pytest.fixture()
+def market_configuration(monkeypatch):
+    monkeypatch.setenv("AWS_ACCESS_KEY_ID", "testing")
+    monkeypatch.setenv("AWS_SECRET_ACCESS_KEY", "testing")
+    with mock_aws():
+        configuration = dict(
+            market_type="AwsMarketV1",
+            bucket=BUCKET,
+            region=REGION,
+            market_metadata_key="/shopkeeper/market=memory-test/metadata-v1.json",
+        )
+        market_data = AwsMarketV1Data(
+            market_type="AwsMarketV1",
+            name="memory-test",
+            metadata={"description": "m" * MARKET_METADATA_SIZE},
+            configuration=configuration,
+            region=REGION,
+            bucket=BUCKET,
+            bucket_arn=f"arn:aws:s3:::{BUCKET}",
+        )
+        s3 = boto3.client("s3", region_name=REGION)
+        s3.create_bucket(Bucket=BUCKET)
+        s3.put_object(
+            Bucket=BUCKET,
+            Key=configuration["market_metadata_key"].lstrip("/"),
+            Body=to_yaml(market_data),
+        )
+        # earlier tests may have closed the event loop with asyncio.run
+        asyncio.set_event_loop(asyncio.new_event_loop())
+        pulumi.runtime.set_mocks(EchoMocks(), preview=False)
+        yield configuration
+
+
+def test_bytes_per_producer(market_configuration):
+    producers = []
+
+    @pulumi.runtime.test
+    def declare_producers(first, n):
+        for i in range(first, first + n):
+            producer = AwsProducerV1(
+                name=f"producer-{i}",
+                args={
+                    "metadata": {"name": f"producer-{i}", "description": "some"},
+                    "market": dict(market_configuration),
+                },
+            )
+            client = producer.market_client
+            for k in range(N_DATASETS):
+                client.declare_resource_metadata(
+                    data=pulumi.Output.from_input(
+                        {"metadata": {"description": "d" * DATASET_METADATA_SIZE}}
+                    ),
+                    key=client.get_dataset_metadata_key(f"producer-{i}", k),
+                    name=f"producer-{i}-dataset-{k}",
+                    opts=ResourceOptions(parent=producer),
+                )
+            producers.append(producer)
+        return pulumi.Output.all(*[p.producer_data for p in producers])
+
+    # warm up imports and caches
+    declare_producers(0, 5)
+
+    n = 20
+    gc.collect()
+    tracemalloc.start()
+    before, _ = tracemalloc.get_traced_memory()
+    declare_producers(1000, n)
+    # the mock monitor keeps all resource state, which the engine keeps elsewhere
+    get_monitor().resources.clear()
+    gc.collect()
+    after, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    bytes_per_producer = (after - before) / n
+    logger.info(f"{bytes_per_producer:.0f} bytes per producer")
+    # neither the market data nor serialized dataset metadata may be kept per producer
+    assert bytes_per_producer < MARKET_METADATA_SIZE
+
+
+def test_drop_outputs_when_registered(market_configuration):
+    objects = []
+
+    @pulumi.runtime.test
+    def declare_object():
+        metadata_object = pulumi_s3.BucketObjectv2(
+            "some-metadata", bucket=BUCKET, key="some-key", content="m" * 1000
+        )
+        _drop_outputs_when_registered(metadata_object)
+        objects.append(metadata_object)
+        return metadata_object.urn
+
+    declare_object()
+    (metadata_object,) = objects
+    assert "content" not in vars(metadata_object)
+    assert "etag" not in vars(metadata_object)
+    urn, id_ = _sync_await(
+        pulumi.Output.all(metadata_object.urn, metadata_object.id).future()
+    )
+    assert urn.endswith("::some-metadata")
+    assert id_ == "some-metadata_id"
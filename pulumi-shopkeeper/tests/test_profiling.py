@@ -0,0 +1,67 @@
+import sys
+import time
+
+import pytest
+from serde import to_dict
+from serde.yaml import to_yaml
+
+from shopkeeper import profiling
+from shopkeeper.aws.market import AwsMarketV1Data, _serialize_metadata
+
+
+@pytest.fixture()
+def profiling_enabled(monkeypatch):
+    monkeypatch.setenv(profiling.PROFILE_ENV_VAR, "1")
+    profiling.reset()
+    yield
+    profiling.reset()
+
+
+def test_profiling_disabled(monkeypatch):
+    monkeypatch.delenv(profiling.PROFILE_ENV_VAR, raising=False)
+
+    def fn(x):
+        return x
+
+    assert profiling.profiled(fn, "SomeType", "some-name", "fn") is fn
+
+
+def test_profiled_callbacks(profiling_enabled):
+    fast = profiling.profiled(lambda x: x, "SomeType", "a", "fast")
+    slow = profiling.profiled(lambda x: time.sleep(x), "SomeType", "a", "slow")
+    also_slow = profiling.profiled(lambda x: time.sleep(x), "SomeType", "b", "slow")
+    fast(1)
+    slow(0.01)
+    also_slow(0.01)
+
+    timings = profiling.component_timings("a")
+    assert timings["fast"].calls == 1
+    assert timings["slow"].seconds >= 0.01
+
+    (typ, step, stats), *_ = profiling.top_callbacks(limit=1)
+    assert (typ, step) == ("SomeType", "slow")
+    assert stats.calls == 2
+    assert stats.seconds >= 0.02
+
+
+def test_memory_high_water_mark(monkeypatch):
+    assert profiling.memory_high_water_mark() > 0
+    # as on windows, where there is no resource module
+    monkeypatch.setitem(sys.modules, "resource", None)
+    assert profiling.memory_high_water_mark() is None
+    profiling.log_report()
+
+
+def test_serialize_metadata():
+    data = AwsMarketV1Data(
+        market_type="AwsMarketV1",
+        name="some-market",
+        metadata={"description": "some market"},
+        configuration={"bucket": "some-bucket", "indexed_fields": ["environment"]},
+        region="eu-west-1",
+        bucket="some-bucket",
+        bucket_arn="arn:aws:s3:::some-bucket",
+    )
+    serialized = _serialize_metadata(data)
+    assert serialized.content == to_yaml(data)
+    assert serialized.data == to_dict(data)
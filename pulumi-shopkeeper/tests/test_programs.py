@@ -9,6 +9,12 @@ logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
 
 
+# the yaml programs don't take an endpoint, so they always deploy to aws
+requires_aws = pytest.mark.skipif(
+    "SHOPKEEPER_ENDPOINT_URL" in os.environ,
+    reason="yaml test programs deploy to AWS, not to SHOPKEEPER_ENDPOINT_URL",
+)
+
 yaml_programs = [
     {
         "stack_name": "aws-market-market",
@@ -72,6 +78,7 @@ def yaml_test_stack(request):
     return stack
 
 
+@requires_aws
 def test_yaml_programs(yaml_test_stack):
     logger.info("updating stack...")
     up_res = yaml_test_stack.up(on_output=logger.info)